@@ -1,25 +1,32 @@
 # -*- coding: utf-8 -*-
 import os
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 import uvicorn
-from fastapi import FastAPI, Query, Depends
+from fastapi import FastAPI, Query, Depends, HTTPException
+from fastapi.responses import PlainTextResponse
 from dotenv import load_dotenv
 
-from auth import get_current_user, auth_router, is_admin
-from schemas import Host, VmReservation, User, ReservationStatusForUser, EditHost, HostAdd, LoadsHost
+from auth import get_current_user, auth_router, is_admin, token_is_admin
+from schemas import Host, VmReservation, User, ReservationStatusForUser, EditHost, HostAdd, LoadsHost, \
+    FleetSummary, FleetDimension, HostStatus, DataCenter, Network, Hypervizor, ConsolidationPlan, ChangesBatch
 from db_models import database
+from profiling import ProfilingMiddleware, profiler
 from db_helper import add_new_host, get_host_info, get_my_vps_requests, change_my_request_status, reject_requests, \
-    get_pending_requests_list, assign_host_with_verification, edit_host_config, get_hosts_and_loads, auto_allocate_requests, add_task
+    get_pending_requests_list, assign_host_with_verification, edit_host_config, get_hosts_and_loads, auto_allocate_requests, add_task, \
+    ensure_fleet_usage, migrate_hosts_to_shards, get_fleet_summary, plan_consolidation, get_changes, compact_changes
 
 load_dotenv()
 app = FastAPI(description="Веб-сервис для планирования количества ресурсов и "
                           "аппаратных хостов на базе поступающих заявок.", title='Otus. Проектная работа')
+app.add_middleware(ProfilingMiddleware, authorize=token_is_admin)
 
 
 @app.on_event("startup")
 async def startup():
     await database.connect()
+    await migrate_hosts_to_shards(database)
+    await ensure_fleet_usage(database)
 
 
 @app.on_event("shutdown")
@@ -78,6 +85,44 @@ async def get_hosts_load(current_user: User = Depends(is_admin)):
     return {'result': result}
 
 
+@app.get('/fleet_summary', tags=['admin_actions'], response_model=Dict[str, List[FleetSummary]],
+         response_model_exclude_none=True)
+async def fleet_summary(group_by: List[FleetDimension] = Query([]), status: Optional[HostStatus] = None,
+                        data_center: Optional[DataCenter] = None, network: Optional[Network] = None,
+                        hypervizor: Optional[Hypervizor] = None, current_user: User = Depends(is_admin)):
+    """Получить суммарную загрузку хостов в разрезе ЦОД, гипервизора, сети и статуса"""
+    filters = {'status': status, 'data_center': data_center, 'network': network, 'hypervizor': hypervizor}
+    result = await get_fleet_summary(database, [dim.value for dim in group_by], filters)
+    return {'result': result}
+
+
+@app.post('/rebuild_fleet_summary', tags=['admin_actions'])
+async def rebuild_fleet_summary(current_user: User = Depends(is_admin)):
+    """Пересобрать агрегаты загрузки хостов"""
+    await ensure_fleet_usage(database, force=True)
+    return {'result': 'success'}
+
+
+@app.get('/consolidation_plan', tags=['admin_actions'], response_model=ConsolidationPlan)
+async def consolidation_plan(max_moves: Optional[int] = Query(None, gt=0), current_user: User = Depends(is_admin)):
+    """Получить план переноса заявок для уплотнения хостов (план не применяется)"""
+    return await plan_consolidation(database, max_moves)
+
+
+@app.get('/changes', tags=['admin_actions'], response_model=ChangesBatch)
+async def changes(since: Optional[str] = None, limit: int = Query(100, gt=0, le=1000),
+                  current_user: User = Depends(is_admin)):
+    """Получить изменения хостов и заявок после курсора since"""
+    return await get_changes(database, since, limit)
+
+
+@app.post('/compact_changes', tags=['admin_actions'])
+async def compact_changes_log(older_than_days: int = Query(30, ge=0), current_user: User = Depends(is_admin)):
+    """Сжать журнал изменений: оставить только последнее событие по каждому объекту"""
+    removed = await compact_changes(database, older_than_days)
+    return {'result': 'success', 'removed': removed}
+
+
 @app.post('/auto_allocate', tags=['admin_actions'])
 async def auto_allocate(current_user: User = Depends(is_admin)):
     """Автоназначение хостов на заявки"""
@@ -85,6 +130,21 @@ async def auto_allocate(current_user: User = Depends(is_admin)):
     return result
 
 
+@app.get('/profiles/{profile_id}', tags=['admin_actions'], response_class=PlainTextResponse)
+async def get_profile(profile_id: str, current_user: User = Depends(is_admin)):
+    """Получить профиль запроса в формате collapsed stacks для построения flame graph"""
+    profile = profiler.profiles.get(profile_id)
+    if not profile:
+        raise HTTPException(status_code=404, detail=f"profile with id: {profile_id} not exists")
+    return profile.folded()
+
+
+@app.get('/slow_requests', tags=['admin_actions'])
+async def get_slow_requests(current_user: User = Depends(is_admin)):
+    """Получить самые медленные запросы со стеками и SQL (режим PROFILING_CONTINUOUS)"""
+    return {'result': [profile.to_dict() for profile in profiler.get_slowest()]}
+
+
 @app.post('/reserve_vps', tags=['user_actions'])
 async def reserve_vps(item: VmReservation, current_user: User = Depends(get_current_user)):
     """Создать заявку на ВМ"""
@@ -48,6 +48,11 @@ async def is_admin(current_user: User = Depends(get_current_user)):
     return current_user
 
 
+async def token_is_admin(token: str):
+    user = await get_token_owner(token)
+    return bool(user and user.is_admin)
+
+
 @auth_router.post("/token", tags=['login'])
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     user = await get_user_from_db(database, form_data.username)
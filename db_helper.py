@@ -1,37 +1,71 @@
 import json
-from collections import Counter
-from sqlalchemy.sql import and_
+import asyncio
+import heapq
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from collections import Counter, defaultdict
+from sqlalchemy.sql import and_, exists, func, select
 from fastapi.exceptions import HTTPException
 from fastapi import status
-from db_models import cpu, storage, storages_set, host, vm_reservation, account
-from schemas import HostStatus, ReservationStatus, Storage, LoadsHost, VmReservation, Host
+from db_models import cpu, storage, storages_set, host, vm_reservation, account, host_usage, fleet_usage, \
+    change_log
+from schemas import HostStatus, ReservationStatus, Storage, LoadsHost, VmReservation, Host, FleetSummary, \
+    ConsolidationPlan, ChangeEntity, ChangeAction, ChangeEvent, ChangesBatch
+from sharding import shard_for, shard_for_request, request_id_offset, all_shards, scatter_fetch_all, \
+    scatter_fetch_one
+
+STORAGE_TYPES = ('ssd', 'hdd', 'sshd')
+USAGE_DIMENSIONS = ('status', 'data_center', 'network', 'hypervizor')
+USAGE_VALUES = ('ram_total', 'ram_free', 'cores_total', 'cores_used') + tuple(
+    f'{storage_type}_{value}' for storage_type in STORAGE_TYPES for value in ('total', 'free'))
+CONSOLIDATION_SCAN_LIMIT = 64
+ENVELOPE_STATUSES = (HostStatus.active, HostStatus.purchased)
+
+capacity_envelope_cache = {}
 
 
 async def add_new_host(db, host_schema):
     if await host_exists(db, host_schema.sku):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="sku must be unique.")
 
-    cpu_id = await add_cpu_if_not_exists(db, host_schema.cpu)
-    await add_storages_set(db, host_schema.storage, host_schema.sku)
-    query = host.insert().values(sku=host_schema.sku,
-                                 status=host_schema.status,
-                                 ram=host_schema.ram,
-                                 cpu_id=cpu_id,
-                                 storage_id=host_schema.sku,
-                                 network=host_schema.network,
-                                 data_center=host_schema.data_center,
-                                 hypervizor=host_schema.hypervizor)
-    result = await db.execute(query)
+    host_db = shard_for(db, host_schema.data_center)
+    async with host_db.transaction():
+        # транзакция начинается с записи: начатая с чтения, она не сможет взять блокировку на запись,
+        # пока параллельно пишет другой запрос ('database is locked')
+        query = host.insert().values(sku=host_schema.sku,
+                                     status=host_schema.status,
+                                     ram=host_schema.ram,
+                                     storage_id=host_schema.sku,
+                                     network=host_schema.network,
+                                     data_center=host_schema.data_center,
+                                     hypervizor=host_schema.hypervizor)
+        result = await host_db.execute(query)
+        cpu_id = await add_cpu_if_not_exists(host_db, host_schema.cpu)
+        await host_db.execute(host.update().where(host.c.sku == host_schema.sku).values(cpu_id=cpu_id))
+        await add_storages_set(host_db, host_schema.storage, host_schema.sku)
+        await refresh_host_usage(db, host_schema.sku)
+        await log_host_change(host_db, host_schema.sku, ChangeAction.created)
+    capacity_envelope_cache.clear()
     return result
 
 
 async def revision_tasks(db, host_item):
     query = vm_reservation.update().where(vm_reservation.c.assigned_to_host == host_item.sku).values(
         status=ReservationStatus.in_consideration, assigned_to_host=None)
-    await db.execute(query)
+    for task_db in get_host_requests_shards(db, host_item):
+        async with task_db.transaction():
+            # сначала запись, затем чтение - иначе транзакция не сможет взять блокировку на запись
+            await task_db.execute(query.values(assigned_to_host=host_item.sku))
+            tasks = await task_db.fetch_all(
+                select([vm_reservation.c.id]).where(vm_reservation.c.assigned_to_host == host_item.sku))
+            await task_db.execute(query)
+            for task in tasks:
+                await log_request_change(task_db, task.id, ChangeAction.revised)
 
 
 async def add_task(db, schema, user_login):
+    await check_feasibility(db, schema)
+    task_db = shard_for(db, schema.data_center)
     query = vm_reservation.insert().values(cpu_cores=schema.cpu_cores,
                                            storage_size=schema.storage_size,
                                            storage_type=schema.storage_type,
@@ -41,16 +75,29 @@ async def add_task(db, schema, user_login):
                                            network=schema.network,
                                            user_login=user_login,
                                            status=ReservationStatus.created)
-    result = await db.execute(query)
+    id_offset = request_id_offset(db, task_db)
+    if id_offset is not None:
+        query = query.values(id=select([func.coalesce(func.max(vm_reservation.c.id), id_offset) + 1]).as_scalar())
+    async with task_db.transaction():
+        result = await task_db.execute(query)
+        await log_request_change(task_db, result, ChangeAction.created)
     return result
 
 
 async def change_my_request_status(db, request_id, new_status):
+    task_db = shard_for_request(db, request_id)
+    client_request = await task_db.fetch_one(vm_reservation.select().where(vm_reservation.c.id == request_id))
+    if client_request and new_status == ReservationStatus.in_consideration:
+        await check_feasibility(db, client_request)
     query = vm_reservation.update().where(vm_reservation.c.id == request_id).values(status=new_status)
-    await db.execute(query)
+    async with task_db.transaction():
+        await task_db.execute(query)
+        await log_request_change(task_db, request_id, ChangeAction.status_changed)
+        await refresh_request_host_usage(db, client_request)
 
 
 async def remove_host_storage(db, host_item, sata_port):
+    db = shard_for(db, host_item.data_center)
     storages = await get_host_storages(db, host_item)
 
     for store in storages:
@@ -67,34 +114,45 @@ async def edit_host_config(db, sku, item):
     host_item = await get_host(db, sku)
     if item.status == HostStatus.purchased:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="not allowed status for this host")
+    host_db = shard_for(db, host_item.data_center)
+    if item.data_center and host_db is not shard_for(db, item.data_center):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="moving host to another data center is not supported in sharded mode")
 
     item_dict = json.loads(item.json())
     fields_for_edit = {k: v for k, v in item_dict.items() if v}
+    storage_action = fields_for_edit.pop('storage_action', None)
 
-    storage_action = fields_for_edit.get('storage_action')
-    if storage_action:
-        add_disks = storage_action.get('add', [])
-        remove_disks = storage_action.get('remove', [])
+    async with host_db.transaction():
+        # транзакция начинается с записи строки хоста (sku=sku, чтобы запрос был корректен и без полей),
+        # иначе при параллельной записи она не сможет повысить блокировку чтения до записи
+        await host_db.execute(host.update().where(host.c.sku == sku).values(sku=sku, **fields_for_edit))
+        if storage_action:
+            add_disks = storage_action.get('add', [])
+            remove_disks = storage_action.get('remove', [])
 
-        if remove_disks:
-            [await remove_host_storage(db, host_item, disk) for disk in remove_disks['sata_port'] if remove_disks]
-        if add_disks:
-            using_ports = {store.sata_port for store in await get_host_storages(db, host_item)}
-            new_ports = {store['sata_port'] for store in add_disks}
+            if remove_disks:
+                [await remove_host_storage(host_db, host_item, disk) for disk in remove_disks['sata_port']
+                 if remove_disks]
+            if add_disks:
+                using_ports = {store.sata_port for store in await get_host_storages(host_db, host_item)}
+                new_ports = {store['sata_port'] for store in add_disks}
 
-            if using_ports.intersection(new_ports):
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                    detail=f"trying to use a busy sata port")
+                if using_ports.intersection(new_ports):
+                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                        detail=f"trying to use a busy sata port")
 
-            await add_storages_set(db, [Storage(**disk) for disk in add_disks], sku)
-            fields_for_edit.pop('storage_action')
-    await db.execute(host.update().where(host.c.sku == sku).values(**fields_for_edit))
+                await add_storages_set(host_db, [Storage(**disk) for disk in add_disks], sku)
 
-    if item.status == HostStatus.destroyed:
-        await revision_tasks(db, host_item)
+        if item.status == HostStatus.destroyed:
+            await revision_tasks(db, host_item)
+        await refresh_host_usage(db, sku)
+        await log_host_change(host_db, sku, ChangeAction.edited)
+    capacity_envelope_cache.clear()
 
 
 async def get_host_storages(db, host_item):
+    db = shard_for(db, host_item.data_center)
     query = storages_set.select().where(storages_set.c.sku == host_item.storage_id)
     storages = await db.fetch_all(query)
     result = []
@@ -106,12 +164,12 @@ async def get_host_storages(db, host_item):
 
 
 async def host_exists(db, sku):
-    host_obj = await db.fetch_one(host.select().where(host.c.sku == sku))
+    host_obj = await scatter_fetch_one(db, host.select().where(host.c.sku == sku))
     return True if host_obj else False
 
 
 async def get_host(db, sku):
-    host_obj = await db.fetch_one(host.select().where(host.c.sku == sku))
+    host_obj = await scatter_fetch_one(db, host.select().where(host.c.sku == sku))
     if not host_obj:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"host with sku: {sku} not exists")
     return host_obj
@@ -119,7 +177,7 @@ async def get_host(db, sku):
 
 async def get_host_info(db, sku):
     host_obj = await get_host(db, sku)
-    cpu_obj = await get_cpu_with_id(db, host_obj.cpu_id)
+    cpu_obj = await get_cpu_with_id(shard_for(db, host_obj.data_center), host_obj.cpu_id)
     storages_obj = await get_host_storages(db, host_obj)
 
     host_dict = dict(host_obj.items())
@@ -161,50 +219,85 @@ async def get_user_from_db(db, username):
 
 
 async def get_my_vps_requests(db, username):
-    my_requests = await db.fetch_all(vm_reservation.select().where(vm_reservation.c.user_login == username))
+    my_requests = await scatter_fetch_all(db, vm_reservation.select().where(vm_reservation.c.user_login == username))
     requests_data = [dict(req.items()) for req in my_requests]
     return [VmReservation(**item) for item in requests_data]
 
 
 async def get_pending_requests_list(db):
     query = vm_reservation.select().where(vm_reservation.c.status == ReservationStatus.in_consideration)
-    pending_requests = await db.fetch_all(query)
+    pending_requests = await scatter_fetch_all(db, query)
     return pending_requests
 
 
 async def reject_requests(db, request_id, description):
+    task_db = shard_for_request(db, request_id)
+    client_request = await task_db.fetch_one(vm_reservation.select().where(vm_reservation.c.id == request_id))
     query = vm_reservation.update().where(vm_reservation.c.id == request_id).values(
         status=ReservationStatus.rejected,
         description=description
     )
-    return await db.execute(query)
+    async with task_db.transaction():
+        result = await task_db.execute(query)
+        await log_request_change(task_db, request_id, ChangeAction.rejected)
+        await refresh_request_host_usage(db, client_request)
+    return result
 
 
 async def get_assigned_requests(db, host_obj):
     query = vm_reservation.select().where(
         and_(vm_reservation.c.status == ReservationStatus.completed,
              vm_reservation.c.assigned_to_host == host_obj.sku))
-    return await db.fetch_all(query)
+    return await scatter_fetch_all(db, query, get_host_requests_shards(db, host_obj))
+
+
+def get_host_requests_shards(db, host_obj):
+    """Заявки хоста хранятся в шарде его ЦОД либо, если ЦОД в заявке не указан, в маршрутизирующем шарде"""
+    return list({shard_for(db, host_obj.data_center), shard_for(db)})
 
 
 async def get_resources_info(db, host_obj):
     requests_assigned_to_host = await get_assigned_requests(db, host_obj)
+    storages = await get_host_storages(db, host_obj)
+    host_cpu = await get_cpu_with_id(shard_for(db, host_obj.data_center), host_obj.cpu_id)
+    return count_resources(host_obj, host_cpu.cores, storages, requests_assigned_to_host)
+
 
+def count_storages(storages, used_storage):
     storages_info = {}
-    for store in await get_host_storages(db, host_obj):
-        result = {'total': store.size, 'free': store.size - sum(
-            [request.storage_size for request in requests_assigned_to_host if
-             request.storage_type == store.storage_type])}
+    for store in storages:
+        result = {'total': store.size, 'free': store.size - used_storage.get(store.storage_type, 0)}
         if not storages_info.get(store.storage_type):
             storages_info[store.storage_type] = result
         else:
             storages_info[store.storage_type] = Counter(storages_info[store.storage_type]) + Counter(result)
+    return storages_info
+
+
+def count_used_storage(requests_assigned_to_host):
+    used_storage = Counter()
+    for request in requests_assigned_to_host:
+        used_storage[request.storage_type] += request.storage_size or 0
+    return used_storage
+
+
+def free_storage(storages_info, storage_type):
+    # хост без дисков нужного типа не ограничивает размер
+    storage_values = storages_info.get(storage_type)
+    return storage_values.get('free', 0) if storage_values else float('inf')
+
+
+def storage_fits_host(storages_info, storage_type, storage_size):
+    return free_storage(storages_info, storage_type) >= (storage_size or 0)
+
+
+def count_resources(host_obj, cores, storages, requests_assigned_to_host):
+    storages_info = count_storages(storages, count_used_storage(requests_assigned_to_host))
 
     free_ram = host_obj.ram - sum([request.ram for request in requests_assigned_to_host])
 
-    host_cpu = await get_cpu_with_id(db, host_obj.cpu_id)
     used_cores = sum([request.cpu_cores for request in requests_assigned_to_host])
-    cpu_cores = {'total': host_cpu.cores, 'used': used_cores}
+    cpu_cores = {'total': cores, 'used': used_cores}
     return free_ram, storages_info, cpu_cores
 
 
@@ -215,8 +308,7 @@ async def verify_requirements(db, client_request, host_obj):
     free_ram, storages_info, cpu_cores = await get_resources_info(db, host_obj)
 
     errors = []
-    storage_type = storages_info.get(client_request.storage_type)
-    if storage_type and storage_type['free'] < client_request.storage_size:
+    if not storage_fits_host(storages_info, client_request.storage_type, client_request.storage_size):
         errors.append('insufficient STORAGE value')
     if free_ram < client_request.ram:
         errors.append('insufficient RAM')
@@ -232,13 +324,20 @@ async def verify_requirements(db, client_request, host_obj):
 
 
 async def assign_task_to_host(db, task_id, host_sku):
-    return await db.execute(
-        vm_reservation.update().where(vm_reservation.c.id == task_id).values(assigned_to_host=host_sku,
-                                                                             status=ReservationStatus.completed))
+    task_db = shard_for_request(db, task_id)
+    client_request = await task_db.fetch_one(vm_reservation.select().where(vm_reservation.c.id == task_id))
+    async with task_db.transaction():
+        result = await task_db.execute(
+            vm_reservation.update().where(vm_reservation.c.id == task_id).values(assigned_to_host=host_sku,
+                                                                                 status=ReservationStatus.completed))
+        await log_request_change(task_db, task_id, ChangeAction.assigned)
+        await refresh_request_host_usage(db, client_request)
+        await refresh_host_usage(db, host_sku)
+    return result
 
 
 async def assign_host_with_verification(db, request_id, host_sku):
-    client_request = await db.fetch_one(vm_reservation.select().where(vm_reservation.c.id == request_id))
+    client_request = await shard_for_request(db, request_id).fetch_one(vm_reservation.select().where(vm_reservation.c.id == request_id))
     host_obj = await get_host(db, host_sku)
 
     passed, msg = await verify_requirements(db, client_request, host_obj)
@@ -254,7 +353,7 @@ def get_loads(total, free, round_val=2):
 
 
 async def get_active_hosts(db):
-    active_hosts = await db.fetch_all(host.select().where(host.c.status == HostStatus.active))
+    active_hosts = await scatter_fetch_all(db, host.select().where(host.c.status == HostStatus.active))
     return active_hosts
 
 
@@ -281,8 +380,7 @@ async def get_hosts_and_loads(db):
 
 
 async def auto_allocate_requests(db):
-    tasks = await get_pending_requests_list(db)
-    active_hosts = await get_active_hosts(db)
+    tasks, active_hosts = await asyncio.gather(get_pending_requests_list(db), get_active_hosts(db))
 
     success = 0
     for active_host in active_hosts:
@@ -293,3 +391,443 @@ async def auto_allocate_requests(db):
                 success += 1
 
     return {'await': len(tasks), 'approved': success}
+
+
+async def get_host_usage(db, host_obj):
+    return make_host_usage(host_obj, await get_resources_info(db, host_obj))
+
+
+def make_host_usage(host_obj, resources):
+    free_ram, storages_info, cpu_cores = resources
+    usage = {dim: getattr(host_obj, dim) for dim in USAGE_DIMENSIONS}
+    usage.update(ram_total=host_obj.ram, ram_free=free_ram,
+                 cores_total=cpu_cores['total'], cores_used=cpu_cores['used'])
+    for storage_type in STORAGE_TYPES:
+        storage_values = storages_info.get(storage_type, {})
+        usage[f'{storage_type}_total'] = storage_values.get('total', 0)
+        usage[f'{storage_type}_free'] = storage_values.get('free', 0)
+    return usage
+
+
+async def apply_fleet_usage(db, usage, sign):
+    key = and_(*[fleet_usage.c[dim] == usage[dim] for dim in USAGE_DIMENSIONS])
+    if await db.fetch_one(fleet_usage.select().where(key)):
+        deltas = {col: fleet_usage.c[col] + sign * usage[col] for col in USAGE_VALUES}
+        await db.execute(fleet_usage.update().where(key).values(hosts=fleet_usage.c.hosts + sign, **deltas))
+    else:
+        deltas = {col: sign * usage[col] for col in USAGE_VALUES}
+        dims = {dim: usage[dim] for dim in USAGE_DIMENSIONS}
+        await db.execute(fleet_usage.insert().values(hosts=sign, **dims, **deltas))
+
+
+async def refresh_host_usage(db, sku):
+    """Пересчитать вклад одного хоста в агрегаты парка"""
+    host_obj = await scatter_fetch_one(db, host.select().where(host.c.sku == sku))
+    if not host_obj:
+        return
+    host_db = shard_for(db, host_obj.data_center)
+    async with host_db.transaction():
+        await remove_host_usage(host_db, sku)
+        new_usage = await get_host_usage(db, host_obj)
+        await apply_fleet_usage(host_db, new_usage, 1)
+        await host_db.execute(host_usage.insert().values(sku=sku, **new_usage))
+
+
+async def remove_host_usage(db, sku):
+    """Вычесть сохраненный вклад хоста из fleet_usage и удалить его строку host_usage"""
+    # начинаем с записи: SQLite не повышает блокировку чтения до записи при конкурентной транзакции
+    # и сразу отвечает 'database is locked'
+    key = exists().where(and_(host_usage.c.sku == sku, *[host_usage.c[dim].isnot_distinct_from(fleet_usage.c[dim])
+                                                         for dim in USAGE_DIMENSIONS]))
+    deltas = {col: fleet_usage.c[col] - select([host_usage.c[col]]).where(host_usage.c.sku == sku).as_scalar()
+              for col in USAGE_VALUES}
+    await db.execute(fleet_usage.update().where(key).values(hosts=fleet_usage.c.hosts - 1, **deltas))
+    await db.execute(host_usage.delete().where(host_usage.c.sku == sku))
+
+
+async def refresh_request_host_usage(db, client_request):
+    if client_request and client_request.assigned_to_host and client_request.status == ReservationStatus.completed:
+        await refresh_host_usage(db, int(client_request.assigned_to_host))
+
+
+async def get_hosts_resources(db, shards, condition=None):
+    """Хосты шардов shards с дисками, назначенными заявками и ресурсами (как в get_resources_info) за три запроса"""
+    hosts_query = select([host, cpu.c.cores]).select_from(host.outerjoin(cpu, host.c.cpu_id == cpu.c.id))
+    if condition is not None:
+        hosts_query = hosts_query.where(condition)
+    storages_query = select([storages_set.c.sku, storage.c.storage_type, storage.c.size]).select_from(
+        storages_set.join(storage, storages_set.c.storage_id == storage.c.id))
+    requests_query = vm_reservation.select().where(vm_reservation.c.status == ReservationStatus.completed)
+
+    hosts_rows, storages = await asyncio.gather(scatter_fetch_all(db, hosts_query, shards),
+                                                scatter_fetch_all(db, storages_query, shards))
+    requests_shards = list({shard for host_obj in hosts_rows for shard in get_host_requests_shards(db, host_obj)})
+    requests = await scatter_fetch_all(db, requests_query, requests_shards) if hosts_rows else []
+
+    storages_by_set, requests_by_host = defaultdict(list), defaultdict(list)
+    for store in storages:
+        storages_by_set[store.sku].append(store)
+    for request in requests:
+        if request.assigned_to_host:
+            requests_by_host[int(request.assigned_to_host)].append(request)
+
+    result = []
+    for host_obj in hosts_rows:
+        host_storages, host_requests = storages_by_set[host_obj.storage_id], requests_by_host[host_obj.sku]
+        resources = count_resources(host_obj, host_obj.cores, host_storages, host_requests)
+        result.append((host_obj, host_storages, host_requests, resources))
+    return result
+
+
+async def rebuild_fleet_usage(db, host_db):
+    """Полностью пересобрать агрегаты парка в шарде host_db"""
+    async with host_db.transaction():
+        await host_db.execute(fleet_usage.delete())
+        await host_db.execute(host_usage.delete())
+        for host_obj, _, _, resources in await get_hosts_resources(db, [host_db]):
+            await host_db.execute(host_usage.insert().values(sku=host_obj.sku, **make_host_usage(host_obj, resources)))
+
+        dims = [host_usage.c[dim] for dim in USAGE_DIMENSIONS]
+        totals = [func.sum(host_usage.c[col]) for col in USAGE_VALUES]
+        query = select([*dims, func.count(host_usage.c.sku), *totals]).group_by(*dims)
+        await host_db.execute(fleet_usage.insert().from_select([*USAGE_DIMENSIONS, 'hosts', *USAGE_VALUES], query))
+
+
+def sum_fleet_usage(usages):
+    totals = defaultdict(lambda: dict.fromkeys(('hosts', *USAGE_VALUES), 0))
+    for usage in usages:
+        total = totals[tuple(usage[dim] for dim in USAGE_DIMENSIONS)]
+        total['hosts'] += usage.get('hosts', 1)
+        for col in USAGE_VALUES:
+            total[col] += usage[col] or 0
+    return {key: total for key, total in totals.items() if any(total.values())}
+
+
+async def fleet_usage_is_consistent(db, host_db):
+    """Сравнить сохраненные агрегаты шарда host_db с пересчитанными по хостам и заявкам"""
+    expected = {host_obj.sku: make_host_usage(host_obj, resources)
+                for host_obj, _, _, resources in await get_hosts_resources(db, [host_db])}
+    stored = {row['sku']: {col: row[col] for col in (*USAGE_DIMENSIONS, *USAGE_VALUES)}
+              for row in await host_db.fetch_all(host_usage.select())}
+    if expected != stored:
+        return False
+    fleet_rows = [dict(row.items()) for row in await host_db.fetch_all(fleet_usage.select())]
+    return sum_fleet_usage(fleet_rows) == sum_fleet_usage(expected.values())
+
+
+async def migrate_hosts_to_shards(db):
+    """Перенести хосты, созданные до включения шардирования, из маршрутизирующей базы в шарды их ЦОД"""
+    routing = shard_for(db)
+    if len(all_shards(db)) == 1:
+        return
+
+    for host_obj in await routing.fetch_all(host.select()):
+        host_db = shard_for(db, host_obj.data_center)
+        if host_db is routing:
+            continue
+        storages = await get_host_storages(routing, host_obj)
+        host_cpu = await get_cpu_with_id(routing, host_obj.cpu_id)
+
+        async with host_db.transaction():
+            if not await host_db.fetch_one(host.select().where(host.c.sku == host_obj.sku)):
+                cpu_id = await add_cpu_if_not_exists(host_db, host_cpu)
+                await add_storages_set(host_db, storages, host_obj.storage_id)
+                await host_db.execute(host.insert().values(**{**dict(host_obj.items()), 'cpu_id': cpu_id}))
+        async with routing.transaction():
+            for store in storages:
+                await routing.execute(storages_set.delete().where(storages_set.c.storage_id == store.id))
+                await routing.execute(storage.delete().where(storage.c.id == store.id))
+            await routing.execute(host_usage.delete().where(host_usage.c.sku == host_obj.sku))
+            await routing.execute(host.delete().where(host.c.sku == host_obj.sku))
+
+
+async def ensure_fleet_usage(db, force=False):
+    for host_db in all_shards(db):
+        if force or not await fleet_usage_is_consistent(db, host_db):
+            await rebuild_fleet_usage(db, host_db)
+
+
+async def get_fleet_summary(db, group_by, filters):
+    dims = [fleet_usage.c[dim] for dim in group_by]
+    totals = [func.sum(fleet_usage.c[col]).label(col) for col in USAGE_VALUES]
+    query = select([*dims, func.sum(fleet_usage.c.hosts).label('hosts'), *totals])
+    conditions = [fleet_usage.c[dim] == value for dim, value in filters.items() if value is not None]
+    if conditions:
+        query = query.where(and_(*conditions))
+    query = query.group_by(*dims)
+
+    groups = defaultdict(Counter)
+    for row in await scatter_fetch_all(db, query):
+        groups[tuple(row[dim] for dim in group_by)].update({col: row[col] or 0 for col in ('hosts', *USAGE_VALUES)})
+
+    result = []
+    for key, row in groups.items():
+        if row['hosts'] <= 0:
+            continue
+        storage_info = {}
+        for storage_type in STORAGE_TYPES:
+            total, free = row[f'{storage_type}_total'], row[f'{storage_type}_free']
+            if total:
+                storage_info[storage_type] = {'total': total, 'free': free, 'loads_perc': get_loads(total, free)}
+
+        result.append(FleetSummary(**dict(zip(group_by, key)), hosts=row['hosts'],
+                                   ram_status={'total': row['ram_total'],
+                                               'free': row['ram_free'],
+                                               'loads_perc': get_loads(row['ram_total'], row['ram_free'])},
+                                   storage_status=storage_info,
+                                   cpu_cores={'total': row['cores_total'], 'used': row['cores_used']}))
+    return result
+
+
+async def get_fleet_capacity(db):
+    """Активные хосты с их свободными ресурсами и назначенными заявками"""
+    hosts = {}
+    for host_obj, storages, requests, (free_ram, storages_info, _) in await get_hosts_resources(
+            db, all_shards(db), host.c.status == HostStatus.active):
+        hosts[host_obj.sku] = {'sku': host_obj.sku,
+                               'pool': (host_obj.hypervizor, host_obj.data_center, host_obj.network),
+                               'cores': host_obj.cores or 0,
+                               'ram_free': free_ram,
+                               'storages': storages,
+                               'used_storage': count_used_storage(requests),
+                               'storages_info': storages_info,
+                               'requests': requests}
+    return hosts
+
+
+def fits_host(request, host_item, ram_free, storages_info):
+    """Та же проверка ресурсов, что и в verify_requirements"""
+    if (request.ram or 0) > ram_free or (request.cpu_cores or 0) > host_item['cores']:
+        return False
+    return storage_fits_host(storages_info, request.storage_type, request.storage_size)
+
+
+def receiver_keys(host_item):
+    keys = {'ram': host_item['ram_free']}
+    keys.update((storage_type, free_storage(host_item['storages_info'], storage_type))
+                for storage_type in STORAGE_TYPES)
+    return keys
+
+
+def add_receiver(receivers, host_item):
+    for name, key in receiver_keys(host_item).items():
+        insort(receivers[name], (key, host_item['sku']))
+
+
+def remove_receiver(receivers, host_item):
+    for name, key in receiver_keys(host_item).items():
+        del receivers[name][bisect_left(receivers[name], (key, host_item['sku']))]
+
+
+def find_receiver(receivers, hosts, trial, request):
+    """Хост с наименьшим подходящим запасом RAM среди не более CONSOLIDATION_SCAN_LIMIT кандидатов"""
+    by_ram, by_storage = receivers['ram'], receivers.get(request.storage_type)
+    ram_position = bisect_left(by_ram, (request.ram or 0, ))
+    storage_position = bisect_left(by_storage, (request.storage_size or 0, )) if by_storage is not None else 0
+
+    def host_state(sku):
+        ram_free, _, storages_info = trial.get(sku, (hosts[sku]['ram_free'], None, hosts[sku]['storages_info']))
+        return ram_free, storages_info
+
+    # просматриваем индекс, в котором меньше хостов с достаточным запасом
+    if by_storage is None or len(by_ram) - ram_position <= len(by_storage) - storage_position:
+        for _, sku in by_ram[ram_position:ram_position + CONSOLIDATION_SCAN_LIMIT]:
+            if fits_host(request, hosts[sku], *host_state(sku)):
+                return sku
+        return None
+
+    fitting = [(host_state(sku)[0], sku)
+               for _, sku in by_storage[storage_position:storage_position + CONSOLIDATION_SCAN_LIMIT]
+               if fits_host(request, hosts[sku], *host_state(sku))]
+    return min(fitting)[1] if fitting else None
+
+
+def plan_pool_consolidation(pool_hosts, max_moves=None):
+    moves, released = [], []
+    loaded = [host_item for host_item in pool_hosts if host_item['requests']]
+    hosts = {host_item['sku']: host_item for host_item in loaded}
+    receivers = {name: [] for name in ('ram', *STORAGE_TYPES)}
+    for host_item in loaded:
+        add_receiver(receivers, host_item)
+    pinned = set()
+
+    candidates = sorted(loaded, key=lambda item: (len(item['requests']), -item['ram_free']))
+    for candidate in candidates:
+        if candidate['sku'] in pinned:
+            continue
+        if max_moves is not None and len(moves) + len(candidate['requests']) > max_moves:
+            continue
+        remove_receiver(receivers, candidate)
+
+        trial, placement = {}, []
+        for request in sorted(candidate['requests'], key=lambda item: item.ram or 0, reverse=True):
+            sku = find_receiver(receivers, hosts, trial, request)
+            if sku is None:
+                break
+            host_item = hosts[sku]
+            ram_free, used_storage, _ = trial.get(sku, (host_item['ram_free'], host_item['used_storage'], None))
+            used_storage = used_storage.copy()
+            used_storage[request.storage_type] += request.storage_size or 0
+            trial[sku] = (ram_free - (request.ram or 0), used_storage, count_storages(host_item['storages'], used_storage))
+            placement.append({'request_id': request.id, 'from_host': candidate['sku'], 'to_host': sku})
+
+        if len(placement) < len(candidate['requests']):
+            add_receiver(receivers, candidate)
+            continue
+
+        for sku, (ram_free, used_storage, storages_info) in trial.items():
+            host_item = hosts[sku]
+            remove_receiver(receivers, host_item)
+            host_item['ram_free'], host_item['used_storage'], host_item['storages_info'] = \
+                ram_free, used_storage, storages_info
+            add_receiver(receivers, host_item)
+            pinned.add(sku)
+        moves.extend(placement)
+        released.append(candidate['sku'])
+
+    return len(loaded), released, moves
+
+
+async def plan_consolidation(db, max_moves=None):
+    """Спланировать перенос заявок для освобождения хостов, не применяя его"""
+    pools = defaultdict(list)
+    for host_item in (await get_fleet_capacity(db)).values():
+        pools[host_item['pool']].append(host_item)
+
+    hosts_before, released_hosts, moves = 0, [], []
+    for pool_hosts in pools.values():
+        pool_limit = None if max_moves is None else max_moves - len(moves)
+        loaded, released, pool_moves = plan_pool_consolidation(pool_hosts, pool_limit)
+        hosts_before += loaded
+        released_hosts.extend(released)
+        moves.extend(pool_moves)
+
+    return ConsolidationPlan(hosts_before=hosts_before, hosts_after=hosts_before - len(released_hosts),
+                             released_hosts=released_hosts, moves=moves)
+
+
+async def get_capacity_envelope(db):
+    """Максимальные ресурсы хоста для каждой комбинации (гипервизор, ЦОД, сеть)"""
+    if capacity_envelope_cache:
+        return capacity_envelope_cache
+
+    pool = [host_usage.c.hypervizor, host_usage.c.data_center, host_usage.c.network]
+    limits = [func.max(host_usage.c.ram_total).label('ram'), func.max(host_usage.c.cores_total).label('cores')]
+    for storage_type in STORAGE_TYPES:
+        limits.append(func.max(host_usage.c[f'{storage_type}_total']).label(f'{storage_type}_max'))
+        limits.append(func.min(host_usage.c[f'{storage_type}_total']).label(f'{storage_type}_min'))
+    query = select([*pool, *limits]).where(host_usage.c.status.in_(ENVELOPE_STATUSES)).group_by(*pool)
+
+    envelope = {}
+    for row in await scatter_fetch_all(db, query):
+        key = (row['hypervizor'], row['data_center'], row['network'])
+        limit = envelope.setdefault(key, dict(row.items()))
+        for column in limit:
+            if column.endswith('_min'):
+                limit[column] = min(limit[column], row[column])
+            elif column not in ('hypervizor', 'data_center', 'network'):
+                limit[column] = max(limit[column], row[column])
+
+    capacity_envelope_cache.update(envelope)
+    return capacity_envelope_cache
+
+
+def storage_fits(limit, storage_type, storage_size):
+    # как и verify_requirements, хост без дисков нужного типа не ограничивает размер
+    return not storage_size or not limit.get(f'{storage_type}_min') or limit[f'{storage_type}_max'] >= storage_size
+
+
+def parse_cpu_cores(cpu_cores):
+    try:
+        return float(cpu_cores or 0)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE, detail='discrepancy CPU')
+
+
+async def check_feasibility(db, client_request):
+    """Отклонить заявку, которую не может выполнить ни один хост парка"""
+    ram, cores = client_request.ram or 0, parse_cpu_cores(client_request.cpu_cores)
+    envelope = await get_capacity_envelope(db)
+    limits = [limit for (hypervizor, data_center, network), limit in envelope.items()
+              if hypervizor == client_request.hypervizor
+              and (not client_request.data_center or data_center == client_request.data_center)
+              and (not client_request.network or network == client_request.network)]
+
+    errors = []
+    if not limits:
+        errors.append('no hosts for HYPERVIZOR, DATACENTER and NETWORK')
+    elif not any(limit['ram'] >= ram and limit['cores'] >= cores and
+                 storage_fits(limit, client_request.storage_type, client_request.storage_size) for limit in limits):
+        if all(limit['ram'] < ram for limit in limits):
+            errors.append('insufficient RAM')
+        if all(limit['cores'] < cores for limit in limits):
+            errors.append('discrepancy CPU')
+        if not any(storage_fits(limit, client_request.storage_type, client_request.storage_size) for limit in limits):
+            errors.append('insufficient STORAGE value')
+        if not errors:
+            errors.append('no hosts pool satisfies RAM, CPU and STORAGE together')
+
+    if errors:
+        raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE, detail=", ".join(errors))
+
+
+async def log_change(db, entity, entity_id, action, payload):
+    await db.execute(change_log.insert().values(entity=entity, entity_id=entity_id, action=action,
+                                                payload=json.dumps(payload, default=str)))
+
+
+async def log_host_change(host_db, sku, action):
+    host_info = await get_host_info(host_db, sku)
+    await log_change(host_db, ChangeEntity.host, sku, action, json.loads(host_info.json()))
+
+
+async def log_request_change(task_db, request_id, action):
+    client_request = await task_db.fetch_one(vm_reservation.select().where(vm_reservation.c.id == request_id))
+    if client_request:
+        await log_change(task_db, ChangeEntity.reservation, request_id, action, dict(client_request.items()))
+
+
+def parse_changes_cursor(db, cursor):
+    shards_count = len(all_shards(db))
+    try:
+        positions = [int(position) for position in cursor.split(',')] if cursor else [0] * shards_count
+    except ValueError:
+        positions = []
+    if len(positions) != shards_count:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"invalid cursor: {cursor}")
+    return positions
+
+
+async def get_changes(db, cursor, limit):
+    """Изменения хостов и заявок после курсора; курсор хранит последний id журнала в каждом шарде"""
+    positions = parse_changes_cursor(db, cursor)
+    batches = await asyncio.gather(*(
+        shard.fetch_all(change_log.select().where(change_log.c.id > position).order_by(change_log.c.id).limit(limit))
+        for shard, position in zip(all_shards(db), positions)))
+
+    merged = heapq.merge(*([(row.created_time, number, row) for row in rows] for number, rows in enumerate(batches)),
+                         key=lambda item: item[:2])
+    changes = []
+    for _, number, row in merged:
+        if len(changes) == limit:
+            break
+        positions[number] = row.id
+        changes.append(ChangeEvent(entity=row.entity, entity_id=row.entity_id, action=row.action,
+                                   created_time=row.created_time, payload=json.loads(row.payload)))
+
+    has_more = sum(len(rows) for rows in batches) > len(changes) or any(len(rows) == limit for rows in batches)
+    return ChangesBatch(changes=changes, cursor=','.join(map(str, positions)), has_more=has_more)
+
+
+async def compact_changes(db, older_than_days):
+    """Удалить из журнала старые события, кроме последнего события по каждому хосту и заявке"""
+    latest = select([func.max(change_log.c.id)]).group_by(change_log.c.entity, change_log.c.entity_id)
+    condition = and_(change_log.c.created_time < datetime.utcnow() - timedelta(days=older_than_days),
+                     change_log.c.id.notin_(latest))
+
+    removed = 0
+    for shard in all_shards(db):
+        async with shard.transaction():
+            await shard.execute(change_log.delete().where(condition))
+            removed += await shard.fetch_val(select([func.changes()]))
+    return removed
@@ -1,17 +1,25 @@
 # -*- coding: utf-8 -*-
 import os
 
-import databases
 from sqlalchemy import Column, Integer, String, ForeignKey, Table, TIMESTAMP, Boolean, create_engine
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 
+from profiling import TracedDatabase
+from sharding import ShardedDatabase
+from schemas import DataCenter
+
 
 Base = declarative_base()
 DATABASE_URL = os.getenv('DATABASE_URL', "sqlite:///./sqlite_db.db")
+SHARDED_STORAGE = os.getenv('SHARDED_STORAGE', '0') == '1'
+SHARD_DATABASE_URL = os.getenv('SHARD_DATABASE_URL', "sqlite:///./sqlite_db_{data_center}.db")
 
-database = databases.Database(DATABASE_URL)
+shard_urls = {dc.value: SHARD_DATABASE_URL.format(data_center=dc.value) for dc in DataCenter} if SHARDED_STORAGE else {}
+database = TracedDatabase(DATABASE_URL)
+if SHARDED_STORAGE:
+    database = ShardedDatabase(database, {dc: TracedDatabase(url) for dc, url in shard_urls.items()})
 metadata = Base.metadata
 
 
@@ -82,11 +90,64 @@ class VmReservation(Base):
     account = relationship("Account", back_populates="vm_reservation")
 
 
+class HostUsage(Base):
+    __tablename__ = 'host_usage'
+    sku = Column(Integer, ForeignKey('host.sku'), primary_key=True)
+    status = Column(String)
+    data_center = Column(String)
+    network = Column(String)
+    hypervizor = Column(String)
+    ram_total = Column(Integer, default=0)
+    ram_free = Column(Integer, default=0)
+    cores_total = Column(Integer, default=0)
+    cores_used = Column(Integer, default=0)
+    ssd_total = Column(Integer, default=0)
+    ssd_free = Column(Integer, default=0)
+    hdd_total = Column(Integer, default=0)
+    hdd_free = Column(Integer, default=0)
+    sshd_total = Column(Integer, default=0)
+    sshd_free = Column(Integer, default=0)
+
+
+class FleetUsage(Base):
+    __tablename__ = 'fleet_usage'
+    id = Column(Integer,  primary_key=True, autoincrement=True)
+    status = Column(String)
+    data_center = Column(String)
+    network = Column(String)
+    hypervizor = Column(String)
+    hosts = Column(Integer, default=0)
+    ram_total = Column(Integer, default=0)
+    ram_free = Column(Integer, default=0)
+    cores_total = Column(Integer, default=0)
+    cores_used = Column(Integer, default=0)
+    ssd_total = Column(Integer, default=0)
+    ssd_free = Column(Integer, default=0)
+    hdd_total = Column(Integer, default=0)
+    hdd_free = Column(Integer, default=0)
+    sshd_total = Column(Integer, default=0)
+    sshd_free = Column(Integer, default=0)
+
+
+class ChangeLog(Base):
+    __tablename__ = 'change_log'
+    id = Column(Integer,  primary_key=True, autoincrement=True)
+    created_time = Column(TIMESTAMP, server_default=func.now(), nullable=False)
+    entity = Column(String, nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    action = Column(String, nullable=False)
+    payload = Column(String)
+
+
 cpu = CPU.__table__
 host = Host.__table__
 storage = Storage.__table__
 vm_reservation = VmReservation.__table__
 account = Account.__table__
+host_usage = HostUsage.__table__
+fleet_usage = FleetUsage.__table__
+change_log = ChangeLog.__table__
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-metadata.create_all(engine)
+for url in [DATABASE_URL, *shard_urls.values()]:
+    engine = create_engine(url, connect_args={"check_same_thread": False})
+    metadata.create_all(engine)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import heapq
+import uuid
+import threading
+from collections import Counter, OrderedDict
+from contextvars import ContextVar
+
+import databases
+
+PROFILING_INTERVAL = float(os.getenv('PROFILING_INTERVAL', 0.005))
+PROFILING_CONTINUOUS = os.getenv('PROFILING_CONTINUOUS', '0') == '1'
+PROFILING_CONTINUOUS_INTERVAL = float(os.getenv('PROFILING_CONTINUOUS_INTERVAL', 0.05))
+PROFILING_TOP_N = int(os.getenv('PROFILING_TOP_N', 20))
+PROFILING_KEEP = int(os.getenv('PROFILING_KEEP', 50))
+
+current_profile = ContextVar('current_profile', default=None)
+
+
+class RequestProfile:
+    def __init__(self, method, path, on_demand):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.on_demand = on_demand
+        self.thread_id = threading.get_ident()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.samples = Counter()
+        self.queries = []
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+
+    def folded(self):
+        """Стеки в формате collapsed stacks (flamegraph.pl, speedscope)"""
+        return '\n'.join(f'{stack} {count}' for stack, count in self.samples.most_common())
+
+    def to_dict(self):
+        return {'id': self.id,
+                'method': self.method,
+                'path': self.path,
+                'duration_ms': round(self.duration * 1000, 2),
+                'samples': sum(self.samples.values()),
+                'queries': [{'sql': str(query), 'duration_ms': round(duration * 1000, 2)}
+                            for query, duration in self.queries],
+                'stacks': self.folded().splitlines()}
+
+
+class Profiler:
+    def __init__(self, interval, continuous, continuous_interval, top_n, keep):
+        self.interval = interval
+        self.continuous = continuous
+        self.continuous_interval = continuous_interval
+        self.top_n = top_n
+        self.keep = keep
+        self.profiles = OrderedDict()
+        self.slowest = []
+        self._active = {}
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def start(self, frame, profile):
+        with self._lock:
+            self._active[frame] = profile
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._run, name='profiler-sampler', daemon=True)
+                self._sampler.start()
+
+    def stop(self, frame, profile):
+        with self._lock:
+            self._active.pop(frame, None)
+        profile.finish()
+
+        if profile.on_demand:
+            self.profiles[profile.id] = profile
+            while len(self.profiles) > self.keep:
+                self.profiles.popitem(last=False)
+        if self.continuous:
+            item = (profile.duration, profile.id, profile)
+            if len(self.slowest) < self.top_n:
+                heapq.heappush(self.slowest, item)
+            elif item > self.slowest[0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def get_slowest(self):
+        return [profile for _, _, profile in sorted(self.slowest, reverse=True)]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                on_demand = any(profile.on_demand for profile in self._active.values())
+            time.sleep(self.interval if on_demand else self.continuous_interval)
+            with self._lock:
+                active = dict(self._active)
+            if active:
+                self._sample(active)
+
+    @staticmethod
+    def _sample(active):
+        threads = sys._current_frames()
+        for thread_id in {profile.thread_id for profile in active.values()}:
+            stack = []
+            frame = threads.get(thread_id)
+            while frame is not None:
+                profile = active.get(frame)
+                if profile is not None:
+                    if stack:
+                        profile.samples[';'.join(reversed(stack))] += 1
+                    break
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+
+
+profiler = Profiler(PROFILING_INTERVAL, PROFILING_CONTINUOUS, PROFILING_CONTINUOUS_INTERVAL,
+                    PROFILING_TOP_N, PROFILING_KEEP)
+
+
+class TracedDatabase(databases.Database):
+    """Database, записывающая SQL-запросы в профиль текущего запроса"""
+
+    async def _traced(self, method, query, *args, **kwargs):
+        profile = current_profile.get()
+        if profile is None:
+            return await method(query, *args, **kwargs)
+
+        started = time.perf_counter()
+        try:
+            return await method(query, *args, **kwargs)
+        finally:
+            profile.queries.append((query, time.perf_counter() - started))
+
+    async def execute(self, query, *args, **kwargs):
+        return await self._traced(super().execute, query, *args, **kwargs)
+
+    async def execute_many(self, query, *args, **kwargs):
+        return await self._traced(super().execute_many, query, *args, **kwargs)
+
+    async def fetch_all(self, query, *args, **kwargs):
+        return await self._traced(super().fetch_all, query, *args, **kwargs)
+
+    async def fetch_one(self, query, *args, **kwargs):
+        return await self._traced(super().fetch_one, query, *args, **kwargs)
+
+    async def fetch_val(self, query, *args, **kwargs):
+        return await self._traced(super().fetch_val, query, *args, **kwargs)
+
+
+class ProfilingMiddleware:
+    """Профилирование запроса по заголовку X-Profile или параметру ?profile=1 (только для администраторов)"""
+
+    def __init__(self, app, authorize, profiler=profiler):
+        self.app = app
+        self.authorize = authorize
+        self.profiler = profiler
+
+    async def is_requested(self, scope):
+        headers = dict(scope['headers'])
+        query = scope.get('query_string', b'').decode()
+        flag = headers.get(b'x-profile', b'').decode().lower() in ('1', 'true') or \
+            any(param in ('profile=1', 'profile=true') for param in query.split('&'))
+        if not flag:
+            return False
+
+        scheme, _, token = headers.get(b'authorization', b'').decode().partition(' ')
+        return scheme.lower() == 'bearer' and await self.authorize(token)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        on_demand = await self.is_requested(scope)
+        if not on_demand and not self.profiler.continuous:
+            return await self.app(scope, receive, send)
+
+        profile = RequestProfile(scope['method'], scope['path'], on_demand)
+
+        async def send_with_profile_id(message):
+            if on_demand and message['type'] == 'http.response.start':
+                message['headers'] = list(message['headers']) + [(b'x-profile-id', profile.id.encode())]
+            await send(message)
+
+        frame = sys._getframe()
+        token = current_profile.set(profile)
+        self.profiler.start(frame, profile)
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            self.profiler.stop(frame, profile)
+            current_profile.reset(token)
@@ -45,6 +45,27 @@ class Network(str, Enum):
     network_segment4 = 'network_segment4'
 
 
+class FleetDimension(str, Enum):
+    status = 'status'
+    data_center = 'data_center'
+    network = 'network'
+    hypervizor = 'hypervizor'
+
+
+class ChangeEntity(str, Enum):
+    host = 'host'
+    reservation = 'reservation'
+
+
+class ChangeAction(str, Enum):
+    created = 'created'
+    edited = 'edited'
+    assigned = 'assigned'
+    rejected = 'rejected'
+    status_changed = 'status_changed'
+    revised = 'revised'
+
+
 class StorageAction(str, Enum):
     add = 'add'
     remove = 'remove'
@@ -167,6 +188,44 @@ class LoadsHost(BaseModel):
     storage_status: Dict
 
 
+class FleetSummary(BaseModel):
+    status: Optional[HostStatus]
+    data_center: Optional[DataCenter]
+    network: Optional[Network]
+    hypervizor: Optional[Hypervizor]
+    hosts: int
+    cpu_cores: Dict
+    ram_status: Dict
+    storage_status: Dict
+
+
+class Migration(BaseModel):
+    request_id: int
+    from_host: int
+    to_host: int
+
+
+class ConsolidationPlan(BaseModel):
+    hosts_before: int
+    hosts_after: int
+    released_hosts: List[int]
+    moves: List[Migration]
+
+
+class ChangeEvent(BaseModel):
+    entity: ChangeEntity
+    entity_id: int
+    action: ChangeAction
+    created_time: datetime
+    payload: Optional[Dict]
+
+
+class ChangesBatch(BaseModel):
+    changes: List[ChangeEvent]
+    cursor: str
+    has_more: bool
+
+
 class VmReservation(BaseModel):
     id: Optional[int]
     created_time = datetime.utcnow()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+RESERVATION_ID_RANGE = 10 ** 9
+
+
+class ShardedDatabase:
+    """Маршрутизирующая база и по одной базе на каждый ЦОД.
+
+    Запросы без явной маршрутизации (учетные записи, заявки без ЦОД) идут в маршрутизирующую базу.
+    Номер шарда заявки определяется по её id: каждому шарду выделен свой диапазон RESERVATION_ID_RANGE.
+    """
+
+    def __init__(self, routing, shards):
+        self.routing = routing
+        self.shards = shards
+        self.databases = [routing, *shards.values()]
+
+    def for_data_center(self, data_center):
+        return self.shards.get(data_center, self.routing) if data_center else self.routing
+
+    def for_request_id(self, request_id):
+        position = request_id // RESERVATION_ID_RANGE
+        return self.databases[position] if 0 <= position < len(self.databases) else self.routing
+
+    def request_id_offset(self, shard):
+        return self.databases.index(shard) * RESERVATION_ID_RANGE
+
+    async def connect(self):
+        await asyncio.gather(*(shard.connect() for shard in self.databases))
+
+    async def disconnect(self):
+        await asyncio.gather(*(shard.disconnect() for shard in self.databases))
+
+    async def execute(self, *args, **kwargs):
+        return await self.routing.execute(*args, **kwargs)
+
+    async def fetch_all(self, *args, **kwargs):
+        return await self.routing.fetch_all(*args, **kwargs)
+
+    async def fetch_one(self, *args, **kwargs):
+        return await self.routing.fetch_one(*args, **kwargs)
+
+    async def fetch_val(self, *args, **kwargs):
+        return await self.routing.fetch_val(*args, **kwargs)
+
+    def transaction(self, *args, **kwargs):
+        return self.routing.transaction(*args, **kwargs)
+
+
+def all_shards(db):
+    return db.databases if isinstance(db, ShardedDatabase) else [db]
+
+
+def shard_for(db, data_center=None):
+    return db.for_data_center(data_center) if isinstance(db, ShardedDatabase) else db
+
+
+def shard_for_request(db, request_id):
+    return db.for_request_id(request_id) if isinstance(db, ShardedDatabase) else db
+
+
+def request_id_offset(db, shard):
+    """Начало диапазона id заявок шарда или None, если шардирование выключено"""
+    return db.request_id_offset(shard) if isinstance(db, ShardedDatabase) else None
+
+
+async def scatter_fetch_all(db, query, shards=None):
+    results = await asyncio.gather(*(shard.fetch_all(query) for shard in shards or all_shards(db)))
+    return [row for rows in results for row in rows]
+
+
+async def scatter_fetch_one(db, query):
+    results = await asyncio.gather(*(shard.fetch_one(query) for shard in all_shards(db)))
+    return next((row for row in results if row is not None), None)